@@ -1,26 +1,103 @@
 import json
+import math
 import pyarrow as pa
 import pyarrow.parquet as pq
 import pyarrow.csv as pacsv
 
+try:
+    import orjson
+except ImportError:  # optional; falls back to json
+    orjson = None
+
+# json fallback: memoize repeated nested values, giving up once more than
+# DEDUP_MAX_RATIO of the first DEDUP_SAMPLE+ rows turn out distinct
+DEDUP_MAX_RATIO = 0.5
+DEDUP_SAMPLE = 1024
+
 def flatten_structs(table: pa.Table) -> pa.Table:
     t = table
     while any(pa.types.is_struct(f.type) for f in t.schema):
         t = t.flatten()
     return t
 
+def _is_nested(t: pa.DataType) -> bool:
+    return (pa.types.is_list(t) or pa.types.is_large_list(t) or pa.types.is_fixed_size_list(t) or
+            pa.types.is_struct(t) or pa.types.is_map(t) or pa.types.is_union(t))
+
+def _needs_stringify(t: pa.DataType) -> bool:
+    # everything else (numbers, strings, timestamps, ...) the CSV writer takes as-is
+    return _is_nested(t) or pa.types.is_binary(t) or pa.types.is_large_binary(t) or pa.types.is_decimal(t)
+
+def _finite_or_none(v):
+    # orjson writes NaN/inf as null; do the same before handing v to json
+    if isinstance(v, float):
+        return v if math.isfinite(v) else None
+    if isinstance(v, dict):
+        return {k: _finite_or_none(x) for k, x in v.items()}
+    if isinstance(v, (list, tuple)):
+        return [_finite_or_none(x) for x in v]
+    return v
+
+def _json_dumps(v) -> str:
+    """json.dumps styled like orjson.dumps: compact, raw UTF-8, NaN/inf as null (float repr may differ)."""
+    try:
+        return json.dumps(v, separators=(",", ":"), ensure_ascii=False, allow_nan=False)
+    except ValueError:  # non-finite float somewhere in v
+        return json.dumps(_finite_or_none(v), separators=(",", ":"), ensure_ascii=False)
+
+def _freeze(v):
+    # hashable key for a to_pylist() value; within a non-union column every
+    # position has one Arrow type, so equal keys always encode to equal JSON
+    if isinstance(v, dict):
+        return tuple((k, _freeze(x)) for k, x in v.items())
+    if isinstance(v, (list, tuple)):
+        return tuple(_freeze(x) for x in v)
+    if v == 0 and isinstance(v, float):
+        return (v, math.copysign(1.0, v))  # 0.0 and -0.0 hash equal but print differently
+    return v
+
+def _json_dumps_dedup(py_vals: list) -> list:
+    """
+    _json_dumps over py_vals, encoding each distinct value once. Only used when
+    orjson is missing; the orjson path encodes every row.
+    """
+    cache = {}
+    out = []
+    for i, v in enumerate(py_vals):
+        if v is None:
+            out.append(None)
+            continue
+        key = _freeze(v)
+        text = cache.get(key)
+        if text is None:
+            text = cache[key] = _json_dumps(v)
+            if i + 1 >= DEDUP_SAMPLE and len(cache) > DEDUP_MAX_RATIO * (i + 1):
+                # high cardinality; hashing costs more than it saves
+                out.append(text)
+                out += [None if w is None else _json_dumps(w) for w in py_vals[i + 1:]]
+                return out
+        out.append(text)
+    return out
+
 def stringify_nested(arr: pa.ChunkedArray) -> pa.ChunkedArray:
     t = arr.type
-    if (pa.types.is_list(t) or pa.types.is_large_list(t) or pa.types.is_fixed_size_list(t) or
-        pa.types.is_struct(t) or pa.types.is_map(t) or pa.types.is_union(t)):
-        # element-wise JSON per row
+    if not _needs_stringify(t):
+        return arr
+    if _is_nested(t):
+        # element-wise JSON per row; one to_pylist() per chunk instead of as_py() per cell
         def to_json_chunk(chunk: pa.Array) -> pa.Array:
-            py_vals = [None if v is None else v.as_py() for v in chunk]
-            return pa.array([None if v is None else json.dumps(v) for v in py_vals], type=pa.string())
+            py_vals = chunk.to_pylist()
+            if orjson is not None:
+                try:
+                    enc = [None if v is None else orjson.dumps(v) for v in py_vals]
+                    return pa.array(enc, type=pa.binary()).cast(pa.string())
+                except TypeError:  # orjson.JSONEncodeError; let json handle it
+                    pass
+            if pa.types.is_union(t):  # mixed value types would make _freeze keys ambiguous
+                return pa.array([None if v is None else _json_dumps(v) for v in py_vals], type=pa.string())
+            return pa.array(_json_dumps_dedup(py_vals), type=pa.string())
         return pa.chunked_array([to_json_chunk(c) for c in arr.chunks], type=pa.string())
-    if pa.types.is_binary(t) or pa.types.is_large_binary(t) or pa.types.is_decimal(t):
-        return pa.compute.cast(arr, pa.string())
-    return arr
+    return pa.compute.cast(arr, pa.string())
 
 def parse_args():
     import argparse
@@ -30,29 +107,44 @@ def parse_args():
     p.add_argument("--selected_cols", nargs="*", default=None)
     return p.parse_args()
 
+def to_csv_table(tbl: pa.Table, use_names: list) -> pa.Table:
+    tbl = flatten_structs(tbl)
+    # chunked columns go to the CSV writer as-is; no combine_chunks() copy
+    arrays = []
+    for name in use_names:
+        col = tbl.column(name)
+        arrays.append(stringify_nested(col) if _needs_stringify(col.type) else col)
+    return pa.Table.from_arrays(arrays, names=use_names)
+
 def main():
     a = parse_args()
-    tbl = pq.read_table(a.parquet_path)
-    tbl = flatten_structs(tbl)
+    pf = pq.ParquetFile(a.parquet_path)
+    # column names/types after flattening, without reading any rows
+    empty = pf.schema_arrow.empty_table()
+    all_names = flatten_structs(empty).column_names
 
-    use_names = tbl.column_names if a.selected_cols is None else [c for c in a.selected_cols if c in tbl.column_names]
-    missing = [] if a.selected_cols is None else [c for c in a.selected_cols if c not in tbl.column_names]
+    use_names = all_names if a.selected_cols is None else [c for c in a.selected_cols if c in all_names]
+    missing = [] if a.selected_cols is None else [c for c in a.selected_cols if c not in all_names]
     if missing:
         print(f"Warning: missing columns skipped: {missing}")
 
-    arrays = []
-    for name in use_names:
-        col = tbl.column(name)
-        col = stringify_nested(col).combine_chunks()
-        arrays.append(col)
-    out = pa.Table.from_arrays(arrays, names=use_names)
+    # only read the top-level columns the selection lives under
+    roots = [f for f in pf.schema_arrow.names
+             if any(n == f or n.startswith(f + ".") for n in use_names)]
+    schema_out = to_csv_table(empty, use_names).schema
+
+    num_rows = 0
+    with pacsv.CSVWriter(a.out_csv, schema_out) as writer:
+        for batch in pf.iter_batches(batch_size=65536, columns=roots):
+            out = to_csv_table(pa.Table.from_batches([batch]), use_names)
 
-    # Verify lengths match original
-    if out.num_rows != tbl.num_rows:
-        raise RuntimeError(f"Row count changed ({out.num_rows} vs {tbl.num_rows}); refusing to write CSV.")
+            # Verify lengths match original
+            if out.num_rows != batch.num_rows:
+                raise RuntimeError(f"Row count changed ({out.num_rows} vs {batch.num_rows}); refusing to write CSV.")
 
-    pacsv.write_csv(out, a.out_csv)
-    print(f"Wrote: {a.out_csv} with {out.num_rows} rows and {len(use_names)} columns.")
+            writer.write_table(out)
+            num_rows += out.num_rows
+    print(f"Wrote: {a.out_csv} with {num_rows} rows and {len(use_names)} columns.")
 
 if __name__ == "__main__":
     main()
@@ -5,6 +5,9 @@ import numpy as np
 import torch
 from bisect import bisect
 import pandas as pd
+
+# HDF5 chunk cache; the 1 MB default cannot hold one compressed ouster chunk
+PC5_CACHE = dict(rdcc_nbytes=256 * 1024 * 1024, rdcc_nslots=10007, rdcc_w0=0.75)
  
 def parse_args():
     parser = argparse.ArgumentParser(description='PC5 file reader')
@@ -25,21 +28,48 @@ def load_lidar_data(pc5_path, lid_id):
         ]
     }
     config = LIDAR['lidars'][lid_id]
-    pc5 = h5py.File(pc5_path, 'r')
+    pc5 = h5py.File(pc5_path, 'r', **PC5_CACHE)
     group_path = config['ouster-packet-ros-topic'].strip('/')
     group = pc5[group_path]
     return config, group
  
+def load_lidar_bundle(pc5_path, lid_id, beams=True):
+    """
+    Opens the .pc5 once and reads everything that doesn't change per frame.
+    Returns a dict with the config, the open file, msgtimes_raw (uint64 ns)
+    and, if beams, beam_direction (Mx3 float32, 0.001 range scale folded in),
+    beam_offset (Mx3 float32) and the range/reflectivity dataset handles.
+    The caller owns bundle['pc5'] and should close it when done.
+    """
+    config, group = load_lidar_data(pc5_path, lid_id)
+    bundle = {
+        'config': config,
+        'pc5': group.file,
+        'msgtimes_raw': group['msgtimes'][:],
+    }
+    if beams:
+        bundle.update({
+            'beam_direction': (group['direction'][:].reshape((3, -1)).T * 0.001).astype(np.float32),
+            'beam_offset': group['offset'][:].reshape((3, -1)).T.astype(np.float32),
+            'range': group['range'],
+            'reflectivity': group['reflectivity'],
+        })
+    return bundle
+ 
 def read_xyz_refl(frame_index, timestamp, msgtimes, rnge, beam_direction, beam_offset, srefl):
     """
     Reads the point cloud data (x, y, z) and reflectivity for a given frame.
     """
     frame_index = bisect(msgtimes, timestamp) if timestamp is not None else frame_index
-    data = rnge[frame_index].flatten() * 0.001
+    # beam_direction already carries the 0.001 range scale
+    data = np.empty(rnge.shape[1:], dtype=np.float32)
+    rnge.read_direct(data, np.s_[frame_index])
+    data = data.reshape(-1)
     valid = data != 0
-    xyz = data[valid, None] * beam_direction[valid, :] + beam_offset[valid, :]
-    refl = srefl[frame_index].flatten()[valid]
-    return xyz, refl
+    xyz = beam_direction * data[:, None]
+    xyz += beam_offset
+    refl = srefl[frame_index].ravel()[valid]
+    return xyz[valid], refl
  
 def create_points_tensor(pts, refl):
     """
@@ -54,7 +84,7 @@ def create_points_tensor(pts, refl):
     points_tensor[:, 3:] = refl[:, None] / 256
     return torch.tensor(points_tensor, dtype=torch.float32)
  
-def read_pc5_frame(pc5_path, lid_name, frame_number, timestamps = None):
+def read_pc5_frame(pc5_path, lid_name, frame_number, timestamps = None, bundle = None):
     """
     Performs the core PC5 file reading functionality.
  
@@ -62,33 +92,38 @@ def read_pc5_frame(pc5_path, lid_name, frame_number, timestamps = None):
         pc5_path (str): Path to the .pc5 file.
         lid_name (str): The name of the lidar sensor (e.g., 'left').
         frame_number (int): The index of the frame to read.
+        bundle (dict): Optional result of load_lidar_bundle, reused across calls
+            (needs beams=True unless timestamps). If omitted, one is loaded for
+            this call and closed afterwards.
  
     Returns:
         tuple: A tuple containing a torch.Tensor of points (x, y, z, reflectivity,
                something_else) and the timestamp in nanoseconds, or None if
                the frame is empty.
     """
-    lid_id = {'top': 0}.get(lid_name, 0)
-    config, group = load_lidar_data(pc5_path, lid_id)
+    if bundle is None:
+        lid_id = {'top': 0}.get(lid_name, 0)
+        # timestamps only need msgtimes; skip reading the beam tables
+        bundle = load_lidar_bundle(pc5_path, lid_id, beams=not timestamps)
+        try:
+            return read_pc5_frame(pc5_path, lid_name, frame_number, timestamps, bundle)
+        finally:
+            bundle['pc5'].close()
  
-    msgtimes = 1e-9 * group['msgtimes'][:] - config['msgtime-offset']
-    beam_direction = group['direction'][:].reshape((3, -1)).T.astype(np.float32)
-    beam_offset = group['offset'][:].reshape((3, -1)).T.astype(np.float32)
-    msgtimes_raw = group['msgtimes'][:]  # uint64 nanoseconds
+    msgtimes_raw = bundle['msgtimes_raw']  # uint64 nanoseconds
     if timestamps:
-        return group['msgtimes'][:]
-    rnge = group['range']
-    srefl = group['reflectivity']
+        return msgtimes_raw
  
+    # frames are addressed by index here, so the seconds array for bisect isn't needed
     try:
         pts, ref = read_xyz_refl(
             frame_index=frame_number,
             timestamp=None,
-            msgtimes=msgtimes,
-            rnge=rnge,
-            beam_direction=beam_direction,
-            beam_offset=beam_offset,
-            srefl=srefl
+            msgtimes=None,
+            rnge=bundle['range'],
+            beam_direction=bundle['beam_direction'],
+            beam_offset=bundle['beam_offset'],
+            srefl=bundle['reflectivity']
         )
         pts_tensor = create_points_tensor(pts, ref)
         if pts_tensor is None:
@@ -1,11 +1,25 @@
 #!/usr/bin/env python3
 import argparse
+import io
+import tarfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, ExitStack
+from multiprocessing import get_context
 from pathlib import Path
-from typing import Optional, Tuple, Iterable, Set, List
-from bisect import bisect
+from typing import Optional, Tuple, Iterable, Set, List, Dict, Union, BinaryIO
+import queue
+import threading
 
 import h5py
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+
+try:
+    from numba import njit, prange, set_num_threads
+except ImportError:  # optional; falls back to the NumPy path in frame_to_xyzi
+    njit = None
 
 
 def parse_args():
@@ -34,9 +48,24 @@ def parse_args():
         type=int,
         help="Export only this 0-based frame index. If omitted, exports ALL frames.",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Worker processes for the frame export (default 1 = serial).",
+    )
+    parser.add_argument(
+        "--pack",
+        action="store_true",
+        help="Write each output type into one <type>.tar under --out_dir instead of one file per frame.",
+    )
     return parser.parse_args()
 
 
+# frames pulled from HDF5 per read (see _slab_size)
+READ_BATCH = 64
+
+
 def compute_selected_formats(formats_arg: Optional[str], to_pcd: bool, to_bin: bool, to_csv: bool) -> Set[str]:
     valid = {"pcd", "bin", "csv"}
 
@@ -67,6 +96,9 @@ def ensure_xyzi(points_np: np.ndarray) -> np.ndarray:
     """
     if points_np.size == 0:
         return points_np.astype(np.float32)
+    if (points_np.ndim == 2 and points_np.shape[1] == 4 and points_np.dtype == np.float32
+            and points_np.flags.c_contiguous):
+        return points_np  # already what the writers need
     xyz = points_np[:, :3]
     if points_np.shape[1] >= 4:
         inten = points_np[:, 3:4]
@@ -91,97 +123,141 @@ def load_lidar_metadata(lid_id: int) -> str:
     return group_path
 
 
-def read_xyz_refl(frame_index: Optional[int],
-                  timestamp: Optional[int],
-                  msgtimes: Optional[np.ndarray],
-                  rnge,
-                  beam_direction: np.ndarray,
-                  beam_offset: np.ndarray,
-                  srefl) -> Tuple[np.ndarray, np.ndarray]:
+def _xyz_into(rng: np.ndarray, beam_direction: np.ndarray, beam_offset: np.ndarray, out: np.ndarray) -> None:
     """
-    Reads the point cloud (x,y,z) and reflectivity for a given frame or timestamp.
+    out[:, k] = rng * beam_direction[k] + beam_offset[k] for each axis k.
+    Beam tables are kept as 3xM rows, so each pass streams contiguous float32.
     """
-    if timestamp is not None:
-        if msgtimes is None:
-            raise ValueError("msgtimes must be provided when timestamp is used")
-        frame_index = bisect(msgtimes, timestamp)
-    assert frame_index is not None
+    for k in range(3):
+        np.multiply(beam_direction[k], rng, out=out[:, k])
+        out[:, k] += beam_offset[k]
 
-    # meters
-    data = rnge[frame_index].flatten() * 0.001
-    valid = data != 0
-    if not np.any(valid):
-        return np.empty((0, 3), dtype=np.float32), np.empty((0,), dtype=np.float32)
 
-    xyz = data[valid, None] * beam_direction[valid, :] + beam_offset[valid, :]
-    refl = srefl[frame_index].flatten()[valid]
-    return xyz.astype(np.float32, copy=False), refl.astype(np.float32, copy=False)
+def _intensity_into(refl: np.ndarray, out: np.ndarray) -> None:
+    """
+    Write reflectivity normalized to [0,1] into out (float32 view, same length).
+    Assumes incoming Ouster reflectivity is 0..255 (uint8-like).
+    """
+    # Normalize reflectivity to 0-1, in place
+    np.multiply(refl, np.float32(1.0 / 255.0), out=out)
+    np.clip(out, 0.0, 1.0, out=out)
+
+    # Optional: drop NaNs in intensity (infs are already clipped to 0/1)
+    np.nan_to_num(out, copy=False, nan=0.0, posinf=1.0, neginf=0.0)
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _build_xyzi(rng, refl, bd, bo, out):
+        """
+        Fused range -> XYZ, reflectivity -> [0,1] intensity in one pass over the frame.
+        Invalid (zero-range) rows are left untouched; the caller compacts them out.
+        Reflectivity comes from integer data, so no NaN handling is needed here.
+        """
+        for i in prange(rng.shape[0]):
+            r = rng[i]
+            if r == 0:
+                continue
+            out[i, 0] = r * bd[0, i] + bo[0, i]
+            out[i, 1] = r * bd[1, i] + bo[1, i]
+            out[i, 2] = r * bd[2, i] + bo[2, i]
+            out[i, 3] = min(max(refl[i] / 255.0, 0.0), 1.0)
+else:
+    _build_xyzi = None
 
 
-def create_points_array(pts: np.ndarray, refl: np.ndarray) -> Optional[np.ndarray]:
+def frame_to_xyzi(range_frame: np.ndarray,
+                  refl_frame: np.ndarray,
+                  beam_direction: np.ndarray,
+                  beam_offset: np.ndarray,
+                  xyzi_buf: np.ndarray,
+                  compact_buf: np.ndarray) -> Optional[np.ndarray]:
     """
-    Return Nx4 XYZI float32 array with intensity normalized to [0,1].
-    Assumes incoming Ouster reflectivity is 0..255 (uint8-like).
+    In-memory HxW range/reflectivity frame -> compact Nx4 XYZI float32, or None if empty.
+    xyzi_buf and compact_buf are Mx4 float32 scratch; the result is a view of one of them.
+    XYZI is built for every beam (numba kernel when available, else NumPy), then
+    valid rows are compacted with a single np.compress, skipped for fully dense frames.
     """
-    n = pts.shape[0]
+    rng = range_frame.reshape(-1)
+    valid = rng != 0
+    n = int(np.count_nonzero(valid))
     if n == 0:
-        print("create_points_array: received 0 points.")
         return None
-    out = np.empty((n, 4), dtype=np.float32)
-    out[:, :3] = pts
 
-    # Normalize reflectivity to 0-1
-    out[:, 3] = (refl.astype(np.float32) / 255.0)
-    np.clip(out[:, 3], 0.0, 1.0, out=out[:, 3])
+    if _build_xyzi is None:
+        _xyz_into(rng, beam_direction, beam_offset, xyzi_buf)
+        _intensity_into(refl_frame.reshape(-1), xyzi_buf[:, 3])
+    else:
+        _build_xyzi(rng, refl_frame.reshape(-1), beam_direction, beam_offset, xyzi_buf)
+    if n == rng.shape[0]:
+        return xyzi_buf  # every beam returned; nothing to compact
+    return np.compress(valid, xyzi_buf, axis=0, out=compact_buf[:n])
+
 
-    # Optional: drop NaNs/Infs in intensity
-    mask = np.isfinite(out[:, 3])
-    if not np.all(mask):
-        out[:, 3][~mask] = 0.0
+# PCD header lines that don't depend on the point count
+PCD_HEADER_PREFIX = (
+    "# .PCD v0.7 - Point Cloud Data file format\n"
+    "VERSION 0.7\n"
+    "FIELDS x y z intensity\n"
+    "SIZE 4 4 4 4\n"
+    "TYPE F F F F\n"
+    "COUNT 1 1 1 1\n"
+).encode("ascii")
 
-    return out
 
+@contextmanager
+def _open_out(out: Union[Path, BinaryIO]):
+    """
+    Yield a binary stream for out: a Path is created/opened (1 MB buffered),
+    an already open stream (e.g. BytesIO for --pack) is used as-is.
+    """
+    if isinstance(out, (str, Path)):
+        out = Path(out)
+        out.parent.mkdir(parents=True, exist_ok=True)
+        with open(out, "wb", buffering=1 << 20) as f:
+            yield f
+    else:
+        yield out
 
-def save_as_pcd_binary(xyzi: np.ndarray, out_path: Path) -> None:
+
+def save_as_pcd_binary(xyzi: np.ndarray, out_path: Union[Path, BinaryIO]) -> None:
     """
     Write binary PCD (FIELDS x y z intensity, float32) with intensity in [0,1].
+    The payload is written from a memoryview; conforming C-contiguous float32 input is not copied.
     """
+    xyzi = np.ascontiguousarray(xyzi, dtype=np.float32)
     n = int(xyzi.shape[0])
-    header = (
-        "# .PCD v0.7 - Point Cloud Data file format\n"
-        "VERSION 0.7\n"
-        "FIELDS x y z intensity\n"
-        "SIZE 4 4 4 4\n"
-        "TYPE F F F F\n"
-        "COUNT 1 1 1 1\n"
-        f"WIDTH {n}\n"
-        "HEIGHT 1\n"
-        "VIEWPOINT 0 0 0 1 0 0 0\n"
-        f"POINTS {n}\n"
-        "DATA binary\n"
-    )
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(out_path, "wb") as f:
+    header = f"WIDTH {n}\nHEIGHT 1\nVIEWPOINT 0 0 0 1 0 0 0\nPOINTS {n}\nDATA binary\n"
+    with _open_out(out_path) as f:
+        f.write(PCD_HEADER_PREFIX)
         f.write(header.encode("ascii"))
-        f.write(xyzi.astype(np.float32, copy=False).tobytes(order="C"))
+        f.write(memoryview(xyzi).cast("B"))
 
 
-def save_as_bin(xyzi: np.ndarray, out_path: Path) -> None:
+def save_as_bin(xyzi: np.ndarray, out_path: Union[Path, BinaryIO]) -> None:
     """
     Write KITTI-style .bin (float32 XYZI).
     Intensity is expected to be in [0,1] (KITTI convention).
     """
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    xyzi.astype(np.float32, copy=False).tofile(out_path)
+    xyzi = np.ascontiguousarray(xyzi, dtype=np.float32)
+    with _open_out(out_path) as f:
+        f.write(memoryview(xyzi).cast("B"))
 
 
-def save_as_csv(xyzi: np.ndarray, out_path: Path) -> None:
+def save_as_csv(xyzi: np.ndarray, out_path: Union[Path, BinaryIO]) -> None:
     """
-    Write CSV with headers x,y,z,i (float32).
+    Write CSV with headers x,y,z,i (float32), each value in shortest
+    round-trip form rather than fixed decimals.
     """
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    header = "x,y,z,i"
-    np.savetxt(out_path, xyzi, fmt="%.6f", delimiter=",", header=header, comments="")
+    table = pa.table({name: xyzi[:, k] for k, name in enumerate("xyzi")})
+    # Arrow quotes header names by default, so write the plain header ourselves
+    with _open_out(out_path) as f:
+        f.write(b"x,y,z,i\n")
+        pacsv.write_csv(table, f, write_options=pacsv.WriteOptions(include_header=False))
+
+
+# output sub-directories (or <name>.tar with --pack) written per format
+FORMAT_DIRS = {"pcd": ("pcd",), "bin": ("bin", "bin_k"), "csv": ("csv",)}
 
 
 def export_frame(
@@ -189,10 +265,14 @@ def export_frame(
     msg_ns: int,
     out_dir: str,
     formats: Iterable[str],
+    ncbin_buf: Optional[np.ndarray] = None,
+    packs: Optional[Dict[str, tarfile.TarFile]] = None,
 ) -> Optional[Tuple[str, int]]:
     """
     points_xyzi: (N, 4) np.float32 array
     msg_ns: timestamp in integer nanoseconds
+    ncbin_buf: optional (>=N, 5) float32 scratch with a zero 5th column, reused for nuScenes .bin
+    packs: optional open tar per FORMAT_DIRS entry; files are added there instead of out_dir
     Writes <secs.nsecs>.* for selected formats
     """
     secs = msg_ns // 1_000_000_000
@@ -204,15 +284,31 @@ def export_frame(
         return None
 
     root = Path(out_dir)
+
+    def write(save, arr, sub, name):
+        if packs is None:
+            save(arr, root / sub / name)
+            return
+        buf = io.BytesIO()
+        save(arr, buf)
+        info = tarfile.TarInfo(name)
+        info.size = buf.tell()
+        info.mtime = int(time.time())
+        buf.seek(0)
+        packs[sub].addfile(info, buf)
+
     if "pcd" in formats:
-        save_as_pcd_binary(xyzi, root / f"pcd/{ts}.pcd")
+        write(save_as_pcd_binary, xyzi, "pcd", f"{ts}.pcd")
     if "bin" in formats:
-        ncbin = np.zeros((xyzi.shape[0], 5), dtype=np.float32)
+        if ncbin_buf is None:
+            ncbin = np.zeros((xyzi.shape[0], 5), dtype=np.float32)
+        else:
+            ncbin = ncbin_buf[:xyzi.shape[0]]  # column 4 is never written, stays 0
         ncbin[:, :4] = xyzi
-        save_as_bin(ncbin, root / f"bin/{ts}.bin") # nusc needs 1x5 cells
-        save_as_bin(xyzi, root / f"bin_k/{ts}.bin")  # kitti needs 1x4 cells
+        write(save_as_bin, ncbin, "bin", f"{ts}.bin") # nusc needs 1x5 cells
+        write(save_as_bin, xyzi, "bin_k", f"{ts}.bin")  # kitti needs 1x4 cells
     if "csv" in formats:
-        save_as_csv(xyzi, root / f"csv/{ts}.csv")
+        write(save_as_csv, xyzi, "csv", f"{ts}.csv")
 
     return ts, int(xyzi.shape[0])
 
@@ -225,59 +321,202 @@ def _resolve_indices(num_frames: int, single_frame: Optional[int]) -> List[int]:
     return [single_frame]
 
 
-def convert_pc5_frames(pc5_path: str, lidar_name: str, out_dir: str, formats: Iterable[str], frame: Optional[int]) -> None:
+def _slab_size(dset, batch: int = READ_BATCH) -> int:
     """
-    Iterates selected frames in the pc5 and writes requested formats for each.
-    Pure NumPy pipeline; no DataContainer / Torch.
+    Frames per slab read, rounded to whole HDF5 chunks of dset (the range
+    dataset) along the frame axis so each of its chunks is decompressed once.
+    That is why the file is opened with h5py's default chunk cache: range slabs
+    never re-read a chunk. Reflectivity slabs use the same frame bounds and may
+    straddle its chunks if its chunk shape differs.
     """
-    lid_id = {"top": 0}.get(lidar_name, 0)
-    group_path = load_lidar_metadata(lid_id)
+    chunks = dset.chunks
+    if not chunks or chunks[0] <= 1:
+        return batch
+    return max(1, round(batch / chunks[0])) * chunks[0]
 
-    Path(out_dir).mkdir(parents=True, exist_ok=True)
 
-    exported = 0
-    with h5py.File(pc5_path, "r") as pc5:
-        if group_path not in pc5:
-            raise ValueError(f"HDF5 group '{group_path}' not found in {pc5_path}")
-        group = pc5[group_path]
-
-        msgtimes_raw = group["msgtimes"][:]  # uint64 nanos
+def _split_spans(indices: List[int], batch: int, workers: int) -> List[List[int]]:
+    """
+    Cut contiguous frame indices into whole-slab spans, a few per worker.
+    """
+    per_job = -(-len(indices) // (workers * 4))
+    per_job = -(-per_job // batch) * batch
+    return [indices[s:s + per_job] for s in range(0, len(indices), per_job)]
 
-        # direction/offset stored as 3xM; reshape to Mx3
-        beam_direction = group["direction"][:].reshape((3, -1)).T.astype(np.float32)
-        beam_offset = group["offset"][:].reshape((3, -1)).T.astype(np.float32)
 
-        rnge = group["range"]
-        srefl = group["reflectivity"]
+def _prefetch_slabs(rnge, srefl, indices: List[int], batch: int, depth: int = 2):
+    """
+    Yield (lo, n, range_block, refl_block) slabs read by a background thread, so the
+    next slab is read from HDF5 while the current one is converted and written.
+    Blocks come from a pool of `depth` buffer pairs and are only valid until the
+    next iteration. Range is converted to float32 on read; reflectivity keeps the
+    dataset's native dtype (typically 8/16-bit).
+    """
+    free = queue.Queue()
+    for _ in range(depth):
+        free.put((np.empty((batch,) + rnge.shape[1:], dtype=np.float32),
+                  np.empty((batch,) + srefl.shape[1:], dtype=srefl.dtype)))
+    ready = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            # indices are contiguous, so each slab is one hyperslab read per dataset
+            for start in range(0, len(indices), batch):
+                bufs = free.get()
+                if bufs is None or stop.is_set():
+                    return
+                lo = indices[start]
+                n = min(batch, len(indices) - start)
+                rnge.read_direct(bufs[0], np.s_[lo:lo + n], np.s_[:n])
+                srefl.read_direct(bufs[1], np.s_[lo:lo + n], np.s_[:n])
+                ready.put((lo, n) + bufs)
+            ready.put(None)
+        except BaseException as e:  # re-raised in the consumer
+            ready.put(e)
+
+    reader = threading.Thread(target=produce, name="pc5-prefetch", daemon=True)
+    reader.start()
+    try:
+        while True:
+            item = ready.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+            free.put(item[2:])
+    finally:
+        # unblock the reader if we stop early, then wait for it
+        stop.set()
+        while not ready.empty():
+            ready.get_nowait()
+        free.put(None)
+        reader.join()
+
+
+def _export_indices(group,
+                    indices: List[int],
+                    beam_direction: np.ndarray,
+                    beam_offset: np.ndarray,
+                    msgtimes_raw: np.ndarray,
+                    out_dir: str,
+                    formats: Iterable[str],
+                    first: int,
+                    total: int,
+                    packs: Optional[Dict[str, tarfile.TarFile]] = None) -> int:
+    """
+    Convert and write a contiguous run of frames; returns how many were exported.
+    first/total only feed the progress line; packs is passed through to export_frame.
+    """
+    if not indices:
+        return 0
+    rnge = group["range"]
+    srefl = group["reflectivity"]
 
-        num_frames = int(rnge.shape[0])
-        indices = _resolve_indices(num_frames, frame)
+    # per-frame scratch, reused for every frame
+    batch = min(_slab_size(rnge), len(indices))
+    xyzi_buf = np.empty((beam_direction.shape[1], 4), dtype=np.float32)
+    compact_buf = np.empty_like(xyzi_buf)
+    ncbin_buf = np.zeros((beam_direction.shape[1], 5), dtype=np.float32) if "bin" in formats else None
 
-        for count, idx in enumerate(indices):
-            pts, ref = read_xyz_refl(
-                frame_index=idx,
-                timestamp=None,
-                msgtimes=None,
-                rnge=rnge,
-                beam_direction=beam_direction,
-                beam_offset=beam_offset,
-                srefl=srefl,
-            )
-
-            xyzi = create_points_array(pts, ref)
+    exported = 0
+    for lo, n, range_block, refl_block in _prefetch_slabs(rnge, srefl, indices, batch):
+        for j in range(n):
+            idx = lo + j
+            xyzi = frame_to_xyzi(range_block[j], refl_block[j], beam_direction, beam_offset,
+                                 xyzi_buf, compact_buf)
             if xyzi is None or xyzi.size == 0:
                 print(f" {idx}: no valid points")
                 continue
 
             msg_ns = int(msgtimes_raw[idx])
-            res = export_frame(xyzi, msg_ns, out_dir, formats=formats)
+            res = export_frame(xyzi, msg_ns, out_dir, formats=formats, ncbin_buf=ncbin_buf, packs=packs)
             if res is None:
                 print(f" {idx}: zero after")
                 continue
 
             ts, npts = res
             exported += 1
-            print(f"{count+1}/{len(indices)}  frame={idx} -> {ts}   ({npts} pts)")
+            print(f"{idx-first+1}/{total}  frame={idx} -> {ts}   ({npts} pts)")
+    return exported
+
+
+# per-process state for the worker pool (h5py handles don't pickle)
+_WORKER = {}
+
+
+def _init_worker(pc5_path: str, group_path: str, *shared) -> None:
+    if njit is not None:
+        # one numba thread per process; the pool already covers the cores
+        set_num_threads(1)
+    pc5 = h5py.File(pc5_path, "r")
+    _WORKER["pc5"] = pc5
+    _WORKER["group"] = pc5[group_path]
+    _WORKER["shared"] = shared
+
+
+def _worker_export(indices: List[int]) -> int:
+    return _export_indices(_WORKER["group"], indices, *_WORKER["shared"])
+
+
+def convert_pc5_frames(pc5_path: str,
+                       lidar_name: str,
+                       out_dir: str,
+                       formats: Iterable[str],
+                       frame: Optional[int],
+                       workers: int = 1,
+                       pack: bool = False) -> None:
+    """
+    Iterates selected frames in the pc5 and writes requested formats for each.
+    Pure NumPy pipeline; no DataContainer / Torch.
+    With workers > 1, frame spans are spread over a process pool.
+    With pack, each output type goes into one <out_dir>/<type>.tar (serial only).
+    """
+    lid_id = {"top": 0}.get(lidar_name, 0)
+    group_path = load_lidar_metadata(lid_id)
+
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+
+    with h5py.File(pc5_path, "r") as pc5:
+        if group_path not in pc5:
+            raise ValueError(f"HDF5 group '{group_path}' not found in {pc5_path}")
+        group = pc5[group_path]
+
+        msgtimes_raw = group["msgtimes"][:]  # uint64 nanos
+
+        # direction/offset stored as 3xM; kept that way (one contiguous row per axis).
+        # The mm -> m range scale is folded into the directions once, here.
+        beam_direction = np.ascontiguousarray(group["direction"][:].reshape((3, -1)) * 0.001, dtype=np.float32)
+        beam_offset = np.ascontiguousarray(group["offset"][:].reshape((3, -1)), dtype=np.float32)
+
+        num_frames = int(group["range"].shape[0])
+        indices = _resolve_indices(num_frames, frame)
+        shared = (beam_direction, beam_offset, msgtimes_raw, out_dir, formats, indices[0] if indices else 0, len(indices))
+
+        parallel = workers > 1 and len(indices) > 1
+        if parallel and pack:
+            raise ValueError("--pack writes a single archive per type; use it with --workers 1")
+        if parallel:
+            spans = _split_spans(indices, _slab_size(group["range"]), workers)
+        else:
+            with ExitStack() as stack:
+                packs = None
+                if pack:
+                    # one sequential archive per output type instead of a file per frame
+                    packs = {
+                        sub: stack.enter_context(tarfile.open(Path(out_dir) / f"{sub}.tar", "w|", bufsize=1 << 20))
+                        for fmt in sorted(formats) for sub in FORMAT_DIRS[fmt]
+                    }
+                exported = _export_indices(group, indices, *shared, packs=packs)
+
+    if parallel:
+        # spawn, not fork: the parent's HDF5 state must not leak into workers
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=get_context("spawn"),
+                                 initializer=_init_worker,
+                                 initargs=(pc5_path, group_path) + shared) as pool:
+            exported = sum(pool.map(_worker_export, spans))
 
     scope = "all frames" if frame is None else f"frame {frame}"
     print(f"exported {exported}/{len(indices)} ({scope}) to {out_dir}")
@@ -297,6 +536,8 @@ if __name__ == "__main__":
             args.out_dir,
             formats=selected_formats,
             frame=args.frame,
+            workers=args.workers,
+            pack=args.pack,
         )
     except ValueError as e:
         raise SystemExit(str(e))